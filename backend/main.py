@@ -1,64 +1,227 @@
 import os
+import sys
 import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import logging.handlers
+import queue
+import random
 import secrets
-from datetime import datetime
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlencode
 from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, HTTPException, Query, Depends, status, Header, Form
+from fastapi import FastAPI, HTTPException, Query, Depends, status, Header, Form, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import asyncpg
 import httpx
+import orjson
 from dotenv import load_dotenv
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from cachetools import TTLCache
 
 load_dotenv()
 
-# 简单的token存储（内存中）
-valid_tokens: Dict[str, str] = {}  # token -> username
+logger = logging.getLogger("inactivity")
+
+# 日志写入放到后台线程，事件循环里只做一次入队，避免stdout阻塞
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+# 日志级别（DEBUG/INFO/WARNING/ERROR），低于该级别的日志不会被格式化和输出
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+
+def setup_logging():
+    """配置日志：QueueHandler 入队，QueueListener 在后台线程输出到stdout"""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    # 无效的级别名（如拼写错误）回退到INFO，不让日志配置影响服务启动
+    level = logging.getLevelName(LOG_LEVEL)
+    invalid_level = not isinstance(level, int)
+    if invalid_level:
+        level = logging.INFO
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s %(message)s"))
+    _log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _log_listener.start()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+    if invalid_level:
+        logger.warning("LOG_LEVEL=%s 无效，已使用 INFO", LOG_LEVEL)
+
+
+def stop_logging():
+    """停止后台日志线程，输出队列中剩余的日志"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+# 本地token有效期（小时）
+TOKEN_EXPIRE_HOURS = int(os.getenv("TOKEN_EXPIRE_HOURS", "24"))
+
+# token签名密钥；未配置时每个进程随机生成（重启后token失效，多worker部署时需配置）
+TOKEN_SECRET = os.getenv("TOKEN_SECRET", "").encode("utf-8") or secrets.token_bytes(32)
+# token最大长度，超过的直接拒绝，不做签名计算
+MAX_TOKEN_LENGTH = 256
 
 # 默认用户（生产环境应该从数据库读取）
 DEFAULT_USERNAME = "admin"
 DEFAULT_PASSWORD = "40"
+# 登录校验时比较用的字节形式，启动时编码一次
+DEFAULT_USERNAME_BYTES = DEFAULT_USERNAME.encode("utf-8")
+DEFAULT_PASSWORD_BYTES = DEFAULT_PASSWORD.encode("utf-8")
+
+# 外部API基础URL
+EXTERNAL_API_BASE = os.getenv("EXTERNAL_API_BASE", "https://noupdate.uniuni.site")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时初始化资源，退出时释放（startup/shutdown 定义在下方）"""
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
 
 app = FastAPI(
     title="FastAPI Application",
     description="A FastAPI application",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
-# 配置 CORS
+# 配置 CORS：允许的来源从 CORS_ORIGINS 读取（逗号分隔），生产环境应该指定具体域名
+CORS_ORIGINS = [origin.strip() for origin in os.getenv("CORS_ORIGINS", "*").split(",") if origin.strip()]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # 生产环境应该指定具体域名
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type", "Accept"],
+    max_age=86400,  # 浏览器缓存预检结果一天，减少OPTIONS请求
 )
 
 # Database connection pool
 db_pool: Optional[asyncpg.Pool] = None
+_db_pool_lock = asyncio.Lock()
+
+# 连接池参数（可通过环境变量调整）
+POSTGRES_URL = os.getenv("POSTGRES_URL")
+POSTGRES_POOL_MIN = int(os.getenv("POSTGRES_POOL_MIN", "5"))
+POSTGRES_POOL_MAX = int(os.getenv("POSTGRES_POOL_MAX", "20"))
+POSTGRES_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("POSTGRES_POOL_MAX_INACTIVE_LIFETIME", "300"))
+POSTGRES_STATEMENT_CACHE_SIZE = int(os.getenv("POSTGRES_STATEMENT_CACHE_SIZE", "1024"))
+POSTGRES_COMMAND_TIMEOUT = float(os.getenv("POSTGRES_COMMAND_TIMEOUT", "60"))
+# 查询都是短小的OLTP语句，默认关闭JIT避免编译开销；设为空字符串则使用服务器配置
+POSTGRES_JIT = os.getenv("POSTGRES_JIT", "off")
 
 # Scheduler for cron jobs
 scheduler: Optional[AsyncIOScheduler] = None
 
+# 同步时每攒够多少条记录写入一次数据库（COPY + 一次合并）
+SYNC_WRITE_BATCH_SIZE = int(os.getenv("SYNC_WRITE_BATCH_SIZE", "5000"))
+
+# 单个warehouse同时获取的页数上限
+PAGE_FETCH_CONCURRENCY = int(os.getenv("PAGE_FETCH_CONCURRENCY", "8"))
+
+# 需要定时同步的warehouse列表：从环境变量 SYNC_WAREHOUSES（逗号分隔）读取，未配置则使用默认列表（与前端保持一致）
+SYNC_WAREHOUSES = tuple(w.strip() for w in os.getenv("SYNC_WAREHOUSES", "").split(",") if w.strip()) or (
+    'JFK', 'EWR', 'PHL', 'DCA', 'BOS', 'RDU', 'CLT', 'BUF', 'RIC', 'PIT',
+    'MDT', 'ALB', 'SYR', 'PWM', 'MIA', 'TPA', 'JAX', 'MCO', 'GNV', 'TLH'
+)
+
+# 同时同步的warehouse数量上限（每个warehouse同步期间占用一个数据库连接）
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", "4"))
+
+# 全进程同时向外部API发出的同步请求数上限（所有warehouse共享）
+HTTP_MAX_INFLIGHT = int(os.getenv("HTTP_MAX_INFLIGHT", "32"))
+http_semaphore = asyncio.Semaphore(HTTP_MAX_INFLIGHT)
+
+# 外部API请求失败（429/5xx/网络错误）时的重试设置
+FETCH_MAX_ATTEMPTS = 5
+FETCH_RETRY_MAX_DELAY = 60.0
+FETCH_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# 被外部API限流后，所有同步请求在此时刻（time.monotonic）之前暂停发送
+_rate_limited_until = 0.0
+
+# 外部API连接池参数（可通过环境变量调整）
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "64"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", str(HTTP_MAX_CONNECTIONS)))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+# Shared HTTP client for the external API (keep-alive connections are reused)
+http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get or create the shared external API HTTP client"""
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(
+            # retries：建立连接失败时由transport立即重试；429/5xx等响应的退避重试见 _get_with_retry
+            # 传入transport后client自身的http2/limits参数不再生效，需要设置在transport上
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+                ),
+                retries=3
+            ),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            # 所有外部API请求都期望JSON，公共请求头设置在client上
+            headers={"accept": "application/json"}
+        )
+        # 代理接口会用不同用户的凭据共用这个client，不保存上游返回的cookie，避免串号
+        http_client.cookies.jar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return http_client
+
 
 async def get_db_pool() -> asyncpg.Pool:
     """Get or create database connection pool"""
     global db_pool
-    if db_pool is None:
-        postgres_url = os.getenv("POSTGRES_URL")
-        if not postgres_url:
-            print("ERROR: POSTGRES_URL environment variable is not set")
-            raise ValueError("POSTGRES_URL environment variable is not set")
-        try:
-            print(f"Connecting to database...")
-            db_pool = await asyncpg.create_pool(postgres_url, min_size=1, max_size=10)
-            print(f"✅ Database connection pool created successfully")
-        except Exception as e:
-            print(f"ERROR: Failed to create database connection pool: {e}")
-            raise
+    if db_pool is not None:
+        return db_pool
+    # 加锁避免并发的首次调用各自创建连接池
+    async with _db_pool_lock:
+        if db_pool is None:
+            if not POSTGRES_URL:
+                logger.error("POSTGRES_URL environment variable is not set")
+                raise ValueError("POSTGRES_URL environment variable is not set")
+            try:
+                logger.info("Connecting to database...")
+                db_pool = await asyncpg.create_pool(
+                    POSTGRES_URL,
+                    min_size=POSTGRES_POOL_MIN,
+                    max_size=POSTGRES_POOL_MAX,
+                    max_inactive_connection_lifetime=POSTGRES_POOL_MAX_INACTIVE_LIFETIME,
+                    statement_cache_size=POSTGRES_STATEMENT_CACHE_SIZE,
+                    command_timeout=POSTGRES_COMMAND_TIMEOUT,
+                    server_settings={"jit": POSTGRES_JIT} if POSTGRES_JIT else None
+                )
+                logger.info("✅ Database connection pool created successfully")
+            except Exception as e:
+                logger.error("Failed to create database connection pool: %s", e)
+                raise
     return db_pool
 
 
@@ -84,12 +247,10 @@ async def init_database_tables():
                 )
             """)
             
-            # 创建索引以提高查询性能
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_scan_records_tracking_number 
-                ON scan_records(tracking_number)
-            """)
+            # tracking_number 已经是唯一约束索引的第一列，单列索引是多余的，只会增加写入开销
+            await conn.execute("DROP INDEX IF EXISTS idx_scan_records_tracking_number")
             
+            # 创建索引以提高查询性能
             await conn.execute("""
                 CREATE INDEX IF NOT EXISTS idx_scan_records_warehouse 
                 ON scan_records(warehouse)
@@ -100,6 +261,15 @@ async def init_database_tables():
                 ON scan_records(created_at)
             """)
             
+            # 清理任务和周报查询都按 nonupdated_start_timestamp 范围筛选，共用这一个索引
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_scan_records_nonupdated_start_timestamp
+                ON scan_records(nonupdated_start_timestamp)
+            """)
+            
+            # 周报专用的部分索引与上面的索引重复（周报同样可以走上面的索引），只会增加写入开销
+            await conn.execute("DROP INDEX IF EXISTS idx_scan_records_weekly")
+            
             # 创建weekly_inactivity表
             await conn.execute("""
                 CREATE TABLE IF NOT EXISTS weekly_inactivity (
@@ -133,341 +303,634 @@ async def init_database_tables():
                 ON weekly_inactivity(nonupdated_start_date)
             """)
             
-            print("✅ Database tables initialized successfully")
+            logger.info("✅ Database tables initialized successfully")
     except Exception as e:
-        print(f"❌ Failed to initialize database tables: {e}")
+        logger.error("❌ Failed to initialize database tables: %s", e)
         raise
 
 
+# 外部API token缓存：token无exp声明时使用的有效期（秒），以及提前刷新的余量（秒）
+EXTERNAL_TOKEN_TTL = int(os.getenv("EXTERNAL_TOKEN_TTL", "900"))
+EXTERNAL_TOKEN_REFRESH_MARGIN = 60
+
+_external_token: Optional[str] = None
+_external_token_expires_at: float = 0.0  # time.monotonic() 时间
+
+# 正在进行中的外部API登录请求，并发调用方共享同一个请求（single-flight）
+_external_token_task: Optional[asyncio.Task] = None
+
+
+def _get_token_lifetime(token: str) -> float:
+    """从JWT的exp声明得到token剩余有效期（秒），无法解析时使用默认有效期"""
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"]) - time.time()
+    except Exception:
+        return EXTERNAL_TOKEN_TTL
+
+
 async def get_external_api_token() -> Optional[str]:
-    """获取外部API的认证token"""
+    """获取外部API的认证token
+
+    token缓存到过期前 EXTERNAL_TOKEN_REFRESH_MARGIN 秒；需要登录时同一时刻
+    最多只有一个登录请求在进行。
+    """
+    global _external_token_task
+    if _external_token and time.monotonic() < _external_token_expires_at:
+        return _external_token
+    if _external_token_task is None or _external_token_task.done():
+        _external_token_task = asyncio.create_task(_refresh_external_api_token())
+    # shield：某个调用方被取消时不影响其他等待同一请求的调用方
+    return await asyncio.shield(_external_token_task)
+
+
+def invalidate_external_api_token(token: str):
+    """外部API返回401时作废缓存的token（已被其他调用方刷新过的新token不受影响）"""
+    global _external_token
+    if _external_token == token:
+        _external_token = None
+
+
+async def _refresh_external_api_token() -> Optional[str]:
+    """重新登录并更新token缓存"""
+    global _external_token, _external_token_expires_at
+    token = await _request_external_api_token()
+    if token:
+        _external_token = token
+        _external_token_expires_at = (
+            time.monotonic() + _get_token_lifetime(token) - EXTERNAL_TOKEN_REFRESH_MARGIN
+        )
+    return token
+
+
+# 定时任务登录外部API的表单内容固定不变，启动时编码一次
+_EXTERNAL_LOGIN_BODY = urlencode({
+    "username": DEFAULT_USERNAME,
+    "password": DEFAULT_PASSWORD
+}).encode("utf-8")
+
+
+async def _request_external_api_token() -> Optional[str]:
+    """向外部API发起登录请求获取token"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{EXTERNAL_API_BASE}/api/v1/auth/token",
-                data={
-                    "username": DEFAULT_USERNAME,
-                    "password": DEFAULT_PASSWORD
-                },
-                headers={
-                    "Content-Type": "application/x-www-form-urlencoded",
-                    "accept": "application/json"
-                },
-                timeout=30.0
-            )
-            
-            if response.status_code == 200:
-                response_data = response.json()
-                return response_data.get("access_token")
-            else:
-                print(f"❌ Failed to get external API token: {response.status_code}")
-                return None
+        client = get_http_client()
+        response = await client.post(
+            f"{EXTERNAL_API_BASE}/api/v1/auth/token",
+            content=_EXTERNAL_LOGIN_BODY,
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded"
+            }
+        )
+        
+        if response.status_code == 200:
+            response_data = orjson.loads(response.content)
+            return response_data.get("access_token")
+        else:
+            logger.error("❌ Failed to get external API token: %s", response.status_code)
+            return None
     except Exception as e:
-        print(f"❌ Error getting external API token: {e}")
+        logger.error("❌ Error getting external API token: %s", e)
+        return None
+
+
+# scan_records 批量写入时使用的列（顺序与 _build_scan_record_rows 生成的元组一致）
+SCAN_RECORDS_COLUMNS = [
+    "tracking_number", "order_id", "warehouse", "zone",
+    "driver_id", "current_status", "nonupdated_start_timestamp"
+]
+
+# 临时暂存表：通过 COPY 批量写入，事务结束时自动删除
+SCAN_RECORDS_STAGE_CREATE_SQL = """
+    CREATE TEMP TABLE scan_records_stage (
+        tracking_number VARCHAR(255),
+        order_id VARCHAR(255),
+        warehouse VARCHAR(255),
+        zone VARCHAR(255),
+        driver_id VARCHAR(255),
+        current_status VARCHAR(255),
+        nonupdated_start_timestamp TIMESTAMP
+    ) ON COMMIT DROP
+"""
+
+# 从暂存表合并到 scan_records，使用 INSERT ... ON CONFLICT 来避免重复插入；
+# 已存在且 zone/driver_id/current_status 都没变的记录不做更新，避免产生无意义的新行版本和WAL
+SCAN_RECORDS_MERGE_SQL = """
+    INSERT INTO scan_records (
+        tracking_number, order_id, warehouse, zone, 
+        driver_id, current_status, nonupdated_start_timestamp, updated_at
+    )
+    SELECT
+        tracking_number, order_id, warehouse, zone,
+        driver_id, current_status, nonupdated_start_timestamp, CURRENT_TIMESTAMP
+    FROM scan_records_stage
+    ON CONFLICT (tracking_number, order_id, warehouse, nonupdated_start_timestamp)
+    DO UPDATE SET
+        zone = EXCLUDED.zone,
+        driver_id = EXCLUDED.driver_id,
+        current_status = EXCLUDED.current_status,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE (scan_records.zone, scan_records.driver_id, scan_records.current_status)
+        IS DISTINCT FROM (EXCLUDED.zone, EXCLUDED.driver_id, EXCLUDED.current_status)
+"""
+
+
+def _to_text(value: Any) -> Optional[str]:
+    """把外部API返回的字段转换为VARCHAR列需要的字符串（None保持为None）"""
+    if value is None:
+        return None
+    return value if isinstance(value, str) else str(value)
+
+
+def _parse_timestamp(timestamp_str: Optional[str]) -> Optional[datetime]:
+    """解析外部API返回的时间戳，无法解析时返回None
+
+    scan_records.nonupdated_start_timestamp 是不带时区的 TIMESTAMP 列，
+    带时区的时间统一转换为UTC后去掉时区信息，否则asyncpg无法写入。
+    """
+    if not timestamp_str:
+        return None
+    try:
+        # 解析ISO格式的时间戳（也支持 "YYYY-MM-DD HH:MM:SS"），结尾的Z转换为+00:00
+        if timestamp_str[-1] == 'Z':
+            timestamp_str = timestamp_str[:-1] + '+00:00'
+        timestamp = datetime.fromisoformat(timestamp_str)
+    except (ValueError, TypeError):
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _build_scan_record_rows(items: List[Dict[str, Any]]) -> List[tuple]:
+    """把外部API返回的记录转换为写入 scan_records 的元组
+
+    同一批次里唯一键相同的记录只保留最后一条，否则 INSERT ... SELECT ... ON CONFLICT
+    会因为同一行被更新两次而整体失败。
+    """
+    unique_rows: Dict[tuple, tuple] = {}
+    for item in items:
+        row = (
+            _to_text(item.get("tracking_number")),
+            _to_text(item.get("order_id")),
+            _to_text(item.get("warehouse")),
+            _to_text(item.get("zone")),
+            _to_text(item.get("driver_id")),
+            _to_text(item.get("current_status")),
+            _parse_timestamp(item.get("nonupdated_start_timestamp"))
+        )
+        unique_rows[(row[0], row[1], row[2], row[6])] = row
+    return list(unique_rows.values())
+
+
+async def save_scan_records(conn: asyncpg.Connection, rows: List[tuple]):
+    """COPY 到临时暂存表后一次性合并到 scan_records（整批在同一事务中提交）"""
+    async with conn.transaction():
+        await conn.execute(SCAN_RECORDS_STAGE_CREATE_SQL)
+        await conn.copy_records_to_table(
+            "scan_records_stage",
+            records=rows,
+            columns=SCAN_RECORDS_COLUMNS
+        )
+        await conn.execute(SCAN_RECORDS_MERGE_SQL)
+
+
+# 由记录内容引起的写入错误（字段超长、格式不合法、违反约束等），拆分重试可以隔离出错的记录；
+# 连接断开、超时等其他错误拆分后同样会失败，直接抛出，由调用方放弃这一批
+_ROW_DATA_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+
+async def _save_scan_records_bisect(conn: asyncpg.Connection, rows: List[tuple]) -> int:
+    """写入失败时对半拆分重试，最终只丢弃出错的单条记录，返回写入条数"""
+    try:
+        await save_scan_records(conn, rows)
+        return len(rows)
+    except _ROW_DATA_ERRORS as e:
+        if len(rows) == 1:
+            logger.error("❌ 保存记录失败（tracking_number=%s）: %s", rows[0][0], e)
+            return 0
+    mid = len(rows) // 2
+    return await _save_scan_records_bisect(conn, rows[:mid]) + await _save_scan_records_bisect(conn, rows[mid:])
+
+
+async def _save_scan_records_batch(conn: asyncpg.Connection, rows: List[tuple], chunk_size: int) -> int:
+    """整批写入扫描记录，返回写入条数
+
+    整批因记录内容失败时（例如个别字段超长）改为每 chunk_size 条分批重试，
+    失败的分批再对半拆分，只丢弃出错的记录；连接、超时等其他错误直接抛出。
+    """
+    try:
+        await save_scan_records(conn, rows)
+        return len(rows)
+    except _ROW_DATA_ERRORS as e:
+        logger.warning("批量写入 %s 条记录失败（%s），改为每 %s 条分批写入", len(rows), e, chunk_size)
+    
+    saved = 0
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        try:
+            await save_scan_records(conn, chunk)
+            saved += len(chunk)
+        except _ROW_DATA_ERRORS:
+            saved += await _save_scan_records_bisect(conn, chunk)
+    return saved
+
+
+def _get_retry_delay(response: Optional[httpx.Response], attempt: int) -> float:
+    """计算重试前的等待时间（秒），优先使用 Retry-After / X-RateLimit-Reset 响应头"""
+    delay = min(FETCH_RETRY_MAX_DELAY, 2 ** attempt + random.random())
+    if response is None:
+        return delay
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(FETCH_RETRY_MAX_DELAY, max(0.0, float(retry_after)))
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return min(FETCH_RETRY_MAX_DELAY, max(0.0, retry_at.timestamp() - time.time()))
+            except (TypeError, ValueError):
+                pass
+    reset_delay = _get_rate_limit_reset_delay(response)
+    return delay if reset_delay is None else reset_delay
+
+
+def _get_rate_limit_reset_delay(response: httpx.Response) -> Optional[float]:
+    """解析 X-RateLimit-Reset 得到距离配额重置的秒数，缺失或无法解析时返回None"""
+    reset = response.headers.get("X-RateLimit-Reset")
+    if not reset:
         return None
+    try:
+        reset_value = float(reset)
+    except ValueError:
+        return None
+    # 较大的值视为重置时刻的Unix时间戳，否则视为剩余秒数
+    if reset_value > 1_000_000_000:
+        reset_value -= time.time()
+    return min(FETCH_RETRY_MAX_DELAY, max(0.0, reset_value))
+
+
+def _defer_requests(delay: float):
+    """推迟所有同步请求的放行时刻（只会延后，不会提前）"""
+    global _rate_limited_until
+    _rate_limited_until = max(_rate_limited_until, time.monotonic() + delay)
+
+
+@asynccontextmanager
+async def _request_slot():
+    """等待限流解除并占用一个并发名额
+
+    等待期间放行时刻可能被其他请求的429再次推迟，因此循环检查；
+    排队等名额时也可能被推迟，拿到名额后再确认一次，未到放行时刻就释放名额继续等待。
+    """
+    while True:
+        wait = _rate_limited_until - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+            continue
+        await http_semaphore.acquire()
+        if _rate_limited_until <= time.monotonic():
+            break
+        http_semaphore.release()
+    try:
+        yield
+    finally:
+        http_semaphore.release()
+
+
+async def _get_with_retry(client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
+    """发起GET请求，遇到429/5xx或网络错误时按指数退避重试"""
+    for attempt in range(FETCH_MAX_ATTEMPTS):
+        response = None
+        try:
+            # 限流期间所有请求统一等待，避免并发请求一起撞上429
+            async with _request_slot():
+                response = await client.get(url, **kwargs)
+            if response.status_code not in FETCH_RETRY_STATUS_CODES:
+                # 配额已用完时按重置时间暂停后续请求（重置时间无法解析则不暂停）
+                if response.headers.get("X-RateLimit-Remaining") == "0":
+                    reset_delay = _get_rate_limit_reset_delay(response)
+                    if reset_delay is not None:
+                        _defer_requests(reset_delay)
+                return response
+            error = f"HTTP {response.status_code}"
+        except httpx.HTTPError as e:
+            if attempt == FETCH_MAX_ATTEMPTS - 1:
+                raise
+            error = repr(e)
+        if attempt == FETCH_MAX_ATTEMPTS - 1:
+            return response
+        delay = _get_retry_delay(response, attempt)
+        logger.warning("请求外部API失败（%s），%.1f 秒后重试（第 %s 次）", error, delay, attempt + 1)
+        if response is not None and response.status_code == 429:
+            # 限流对所有请求生效，由下一轮发送前统一等待
+            _defer_requests(delay)
+        else:
+            # 等待时不占用并发名额
+            await asyncio.sleep(delay)
+
+
+async def _fetch_scan_records_page(
+    client: httpx.AsyncClient,
+    token: str,
+    warehouse: Optional[str],
+    page: int,
+    page_size: int,
+    retry_on_401: bool = True
+) -> Optional[Dict[str, Any]]:
+    """从外部API获取一页扫描记录，失败时返回None"""
+    # 构建查询参数（类似API端点）
+    params = {
+        "show_cancelled": "false",
+        "page": page,
+        "page_size": page_size,
+        "sort": "nonupdated_start_timestamp",
+        "order": "desc"
+    }
+    # 如果指定了warehouse，添加到参数中
+    if warehouse:
+        params["warehouse"] = warehouse
+    
+    response = await _get_with_retry(
+        client,
+        f"{EXTERNAL_API_BASE}/api/v1/scan-records/weekly",
+        params=params,
+        headers={
+            "Authorization": f"Bearer {token}"
+        }
+    )
+    
+    if response.status_code == 401 and retry_on_401:
+        # token已失效：作废缓存，重新获取token后重试一次
+        invalidate_external_api_token(token)
+        new_token = await get_external_api_token()
+        if new_token:
+            return await _fetch_scan_records_page(
+                client, new_token, warehouse, page, page_size, retry_on_401=False
+            )
+    
+    if response.status_code != 200:
+        logger.error("❌ 获取扫描记录失败: %s (page %s)", response.status_code, page)
+        return None
+    
+    return orjson.loads(response.content)
+
+
+def _get_total_pages(data: Dict[str, Any], page_size: int) -> int:
+    """根据第一页响应中的分页信息计算总页数"""
+    pagination = data.get("pagination", {})
+    total_pages = pagination.get("total_pages")
+    if not total_pages:
+        # 如果没有分页信息，尝试从total计算
+        total = pagination.get("total") or data.get("total", 0)
+        if total > 0:
+            total_pages = (total + page_size - 1) // page_size
+        else:
+            total_pages = 1
+    return total_pages
 
 
 async def fetch_and_save_scan_records_for_warehouse(warehouse: Optional[str] = None):
-    """获取指定warehouse的扫描记录并写入数据库"""
+    """获取指定warehouse的扫描记录并写入数据库
+
+    先获取第1页得到总页数，剩余页面并发获取（同时进行的请求数受
+    PAGE_FETCH_CONCURRENCY 限制），获取到的记录按 SYNC_WRITE_BATCH_SIZE 条一批写入数据库。
+    """
     warehouse_label = warehouse if warehouse else "所有仓库"
-    print(f"[{datetime.now()}] 开始获取扫描记录 - Warehouse: {warehouse_label}")
+    logger.info("开始获取扫描记录 - Warehouse: %s", warehouse_label)
+    total_saved = 0
     
     try:
         # 获取认证token
         token = await get_external_api_token()
         if not token:
-            print(f"❌ 无法获取认证token，跳过 {warehouse_label} 的数据获取")
+            logger.error("❌ 无法获取认证token，跳过 %s 的数据获取", warehouse_label)
             return 0
         
         pool = await get_db_pool()
-        async with httpx.AsyncClient() as client:
-            page = 1
-            page_size = 100
-            total_saved = 0
-            
-            while True:
-                # 构建查询参数（类似API端点）
-                params = {
-                    "show_cancelled": "false",
-                    "page": page,
-                    "page_size": page_size,
-                    "sort": "nonupdated_start_timestamp",
-                    "order": "desc"
-                }
-                # 如果指定了warehouse，添加到参数中
-                if warehouse:
-                    params["warehouse"] = warehouse
-                
-                response = await client.get(
-                    f"{EXTERNAL_API_BASE}/api/v1/scan-records/weekly",
-                    params=params,
-                    headers={
-                        "Authorization": f"Bearer {token}",
-                        "accept": "application/json"
-                    },
-                    timeout=30.0
-                )
-                
-                if response.status_code != 200:
-                    print(f"❌ 获取扫描记录失败: {response.status_code}")
-                    break
-                
-                data = response.json()
-                items = data.get("data") or data.get("items") or []
-                
-                if not items or len(items) == 0:
-                    break
-                
-                # 批量插入数据库
+        client = get_http_client()
+        page_size = 100
+        
+        # 各页记录先在内存中累积，攒够 SYNC_WRITE_BATCH_SIZE 条（以及最后剩余的）再一次性写入，
+        # 写入时才占用数据库连接；写入用锁串行，保证同一时刻只有一批在写
+        pending_items: List[Dict[str, Any]] = []
+        write_lock = asyncio.Lock()
+        
+        async def flush():
+            nonlocal total_saved
+            async with write_lock:
+                if not pending_items:
+                    return
+                rows = _build_scan_record_rows(pending_items)
+                pending_items.clear()
                 async with pool.acquire() as conn:
-                    for item in items:
-                        try:
-                            # 解析时间戳
-                            timestamp_str = item.get("nonupdated_start_timestamp")
-                            timestamp = None
-                            if timestamp_str:
-                                try:
-                                    # 尝试解析ISO格式的时间戳
-                                    timestamp = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                                except:
-                                    try:
-                                        timestamp = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-                                    except:
-                                        pass
-                            
-                            # 使用 INSERT ... ON CONFLICT 来避免重复插入
-                            await conn.execute("""
-                                INSERT INTO scan_records (
-                                    tracking_number, order_id, warehouse, zone, 
-                                    driver_id, current_status, nonupdated_start_timestamp, updated_at
-                                ) VALUES ($1, $2, $3, $4, $5, $6, $7, CURRENT_TIMESTAMP)
-                                ON CONFLICT (tracking_number, order_id, warehouse, nonupdated_start_timestamp)
-                                DO UPDATE SET
-                                    zone = EXCLUDED.zone,
-                                    driver_id = EXCLUDED.driver_id,
-                                    current_status = EXCLUDED.current_status,
-                                    updated_at = CURRENT_TIMESTAMP
-                            """,
-                                item.get("tracking_number"),
-                                item.get("order_id"),
-                                item.get("warehouse"),
-                                item.get("zone"),
-                                item.get("driver_id"),
-                                item.get("current_status"),
-                                timestamp
-                            )
-                            total_saved += 1
-                        except Exception as e:
-                            print(f"❌ 保存记录失败: {e}, item: {item.get('tracking_number', 'unknown')}")
-                            continue
-                
-                # 检查是否还有更多页面
-                pagination = data.get("pagination", {})
-                total_pages = pagination.get("total_pages")
-                if not total_pages:
-                    # 如果没有分页信息，尝试从total计算
-                    total = pagination.get("total") or data.get("total", 0)
-                    if total > 0:
-                        total_pages = (total + page_size - 1) // page_size
-                    else:
-                        total_pages = 1
-                
-                if page >= total_pages:
-                    break
-                
-                page += 1
-            
-            print(f"✅ {warehouse_label} 数据获取完成，共保存 {total_saved} 条记录")
-            return total_saved
+                    total_saved += await _save_scan_records_batch(conn, rows, page_size)
+        
+        async def collect(items: List[Dict[str, Any]]):
+            pending_items.extend(items)
+            if len(pending_items) >= SYNC_WRITE_BATCH_SIZE:
+                await flush()
+        
+        semaphore = asyncio.Semaphore(PAGE_FETCH_CONCURRENCY)
+        
+        async def fetch_page(page: int):
+            # 单页的获取、解析、写入失败只记录日志，不影响其他页面
+            try:
+                async with semaphore:
+                    # 每页发送前从缓存读取当前token：某一页遇到401刷新token后，其余页面直接使用新token
+                    page_token = await get_external_api_token()
+                    if not page_token:
+                        logger.error("❌ 无法获取认证token，跳过第 %s 页", page)
+                        return
+                    data = await _fetch_scan_records_page(client, page_token, warehouse, page, page_size)
+                items = data.get(items_key) if isinstance(data, dict) else None
+                if items:
+                    await collect(items)
+            except Exception as e:
+                logger.error("❌ 处理第 %s 页扫描记录失败: %s", page, e)
+        
+        first_page = await _fetch_scan_records_page(client, token, warehouse, 1, page_size)
+        # 记录所在字段（"data" 或 "items"）由第1页确定，后续页面直接按该字段读取
+        items_key = "data" if first_page and first_page.get("data") is not None else "items"
+        first_items = first_page.get(items_key) if first_page else None
+        if first_items:
+            await collect(first_items)
+            total_pages = _get_total_pages(first_page, page_size)
+            try:
+                await asyncio.gather(*(fetch_page(page) for page in range(2, total_pages + 1)))
+            finally:
+                # 写入剩余不足一批的记录
+                await flush()
+        
+        logger.info("✅ %s 数据获取完成，共保存 %s 条记录", warehouse_label, total_saved)
+        return total_saved
     
     except Exception as e:
-        print(f"❌ {warehouse_label} 数据获取失败: {e}")
-        return 0
+        # 之前已写入的批次同样计入结果
+        logger.error("❌ %s 数据获取失败: %s（已保存 %s 条记录）", warehouse_label, e, total_saved)
+        return total_saved
 
 
 async def fetch_and_save_scan_records():
     """定时任务：获取所有配置的warehouse的扫描记录并写入数据库"""
-    print(f"[{datetime.now()}] ========== 开始执行定时任务：获取扫描记录 ==========")
+    logger.info("========== 开始执行定时任务：获取扫描记录 ==========")
     
-    # 从环境变量获取warehouse列表，如果没有则使用默认列表
-    warehouses_str = os.getenv("SYNC_WAREHOUSES", "")
-    if warehouses_str:
-        warehouses = [w.strip() for w in warehouses_str.split(",") if w.strip()]
-    else:
-        # 默认仓库列表（与前端保持一致）
-        warehouses = ['JFK', 'EWR', 'PHL', 'DCA', 'BOS', 'RDU', 'CLT', 'BUF', 'RIC', 'PIT', 'MDT', 'ALB', 'SYR', 'PWM', 'MIA', 'TPA', 'JAX', 'MCO', 'GNV', 'TLH']
+    warehouses = SYNC_WAREHOUSES
     
-    if not warehouses:
-        print("⚠️ 未配置需要同步的warehouse，跳过本次任务")
-        return
+    # 多个warehouse并发同步；对外部API的总请求数另由 HTTP_MAX_INFLIGHT 限制，
+    # 遇到限流时按 Retry-After 退避重试，不再在warehouse之间固定等待
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
     
+    async def sync_one(warehouse: str) -> int:
+        async with semaphore:
+            return await fetch_and_save_scan_records_for_warehouse(warehouse)
+    
+    results = await asyncio.gather(*(sync_one(w) for w in warehouses), return_exceptions=True)
     total_all_saved = 0
-    for warehouse in warehouses:
-        saved_count = await fetch_and_save_scan_records_for_warehouse(warehouse)
-        total_all_saved += saved_count
-        # 每个warehouse之间稍作延迟，避免请求过快
-        await asyncio.sleep(60)
+    for warehouse, result in zip(warehouses, results):
+        if isinstance(result, BaseException):
+            logger.error("❌ %s 数据同步异常: %s", warehouse, result)
+        else:
+            total_all_saved += result
+    
+    # 大批量写入后更新统计信息，让清理和周报查询使用准确的执行计划
+    try:
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            await conn.execute("ANALYZE scan_records")
+    except Exception as e:
+        logger.error("❌ 更新 scan_records 统计信息失败: %s", e)
     
-    print(f"[{datetime.now()}] ========== 定时任务完成，共处理 {len(warehouses)} 个warehouse，总计保存 {total_all_saved} 条记录 ==========")
+    logger.info("========== 定时任务完成，共处理 %s 个warehouse，总计保存 %s 条记录 ==========", len(warehouses), total_all_saved)
 
 
-async def cleanup_old_scan_records():
-    """定时任务：删除超过15天的扫描记录"""
-    print(f"[{datetime.now()}] ========== 开始执行清理任务：删除超过15天的扫描记录 ==========")
+async def cleanup_old_scan_records() -> Optional[int]:
+    """定时任务：删除超过15天的扫描记录，返回删除条数，失败时返回None"""
+    logger.info("========== 开始执行清理任务：删除超过15天的扫描记录 ==========")
     
     try:
         pool = await get_db_pool()
         async with pool.acquire() as conn:
-            # 先统计要删除的记录数
-            count_before = await conn.fetchval("""
-                SELECT COUNT(*) FROM scan_records
-                WHERE nonupdated_start_timestamp < CURRENT_DATE - INTERVAL '15 days'
-            """)
-            
-            if count_before == 0:
-                print("✅ 没有需要清理的记录")
-                return 0
-            
-            # 执行删除操作
+            # 直接删除，不再预先COUNT（否则要多扫描一遍相同的行）
             result = await conn.execute("""
                 DELETE FROM scan_records
                 WHERE nonupdated_start_timestamp < CURRENT_DATE - INTERVAL '15 days'
             """)
             
-            # asyncpg的execute返回格式类似 "DELETE 123"，提取数字
-            deleted_count = 0
-            if result:
-                try:
-                    # 从返回字符串中提取数字（格式：'DELETE 123'）
-                    if isinstance(result, str):
-                        parts = result.split()
-                        if len(parts) >= 2:
-                            deleted_count = int(parts[1])
-                    else:
-                        deleted_count = int(result) if str(result).isdigit() else 0
-                except (ValueError, AttributeError):
-                    # 如果解析失败，使用之前统计的数量
-                    deleted_count = count_before or 0
+            # asyncpg的execute返回格式类似 "DELETE 123"，从中提取删除的行数
+            try:
+                deleted_count = int(result.split()[-1])
+            except (ValueError, AttributeError, IndexError):
+                deleted_count = 0
+            
+            if deleted_count == 0:
+                logger.info("✅ 没有需要清理的记录")
+                return 0
             
-            print(f"✅ 清理任务完成，删除了 {deleted_count} 条超过15天的记录")
+            logger.info("✅ 清理任务完成，删除了 %s 条超过15天的记录", deleted_count)
             return deleted_count
     
     except Exception as e:
-        print(f"❌ 清理任务执行失败: {e}")
-        import traceback
-        print(traceback.format_exc())
-        return 0
+        logger.exception("❌ 清理任务执行失败: %s", e)
+        return None
+
+
+# 周报数据：从scan_records筛选后直接在数据库端写入weekly_inactivity
+# status/driver_id 只接受：可选首尾空白 + 可选正负号 + 1~10位ASCII数字（不支持下划线分隔），
+# 且数值在int4范围内，满足时才转换，否则为NULL；
+# warehouse/tno 为空或超出目标列长度的记录会被跳过；route、team_name、if_driver_lost 暂时为NULL
+WEEKLY_INACTIVITY_REPORT_SQL = r"""
+    INSERT INTO weekly_inactivity (
+        warehouse, tno, nonupdated_start_date, status,
+        route, driver_id, team_name, if_driver_lost, updated_at
+    )
+    SELECT
+        warehouse,
+        tracking_number,
+        nonupdated_start_timestamp,
+        CASE
+            WHEN current_status !~ '^[ \t\n\r\f\v]*[+-]?[0-9]{1,10}[ \t\n\r\f\v]*$' THEN NULL
+            WHEN current_status::bigint BETWEEN -2147483648 AND 2147483647 THEN current_status::int
+        END,
+        NULL::int,
+        CASE
+            WHEN driver_id !~ '^[ \t\n\r\f\v]*[+-]?[0-9]{1,10}[ \t\n\r\f\v]*$' THEN NULL
+            WHEN driver_id::bigint BETWEEN -2147483648 AND 2147483647 THEN driver_id::int
+        END,
+        NULL::varchar,
+        NULL::boolean,
+        NOW()
+    FROM (
+        SELECT DISTINCT
+            tracking_number,
+            order_id,
+            warehouse,
+            driver_id,
+            current_status,
+            nonupdated_start_timestamp
+        FROM scan_records
+        WHERE nonupdated_start_timestamp > CURRENT_DATE - INTERVAL '14 days'
+        AND nonupdated_start_timestamp < CURRENT_DATE - INTERVAL '6 days'
+        AND current_status != '203'
+        AND current_status != '213'
+    ) AS records
+    WHERE warehouse IS NOT NULL AND char_length(warehouse) <= 50
+    AND tracking_number IS NOT NULL AND char_length(tracking_number) <= 100
+"""
 
 
-async def generate_weekly_inactivity_report():
-    """定时任务：每周日生成周报数据，从scan_records写入weekly_inactivity表"""
-    print(f"[{datetime.now()}] ========== 开始执行周报生成任务 ==========")
+async def generate_weekly_inactivity_report() -> Optional[int]:
+    """定时任务：每周日生成周报数据，从scan_records写入weekly_inactivity表
+
+    返回插入条数，失败时返回None。
+    """
+    logger.info("========== 开始执行周报生成任务 ==========")
     
     try:
         pool = await get_db_pool()
         async with pool.acquire() as conn:
-            records = await conn.fetch("""
-                SELECT DISTINCT 
-                    tracking_number,
-                    order_id,
-                    warehouse,
-                    driver_id,
-                    current_status,
-                    nonupdated_start_timestamp
-                FROM scan_records
-                WHERE nonupdated_start_timestamp > CURRENT_DATE - INTERVAL '14 days'
-                AND nonupdated_start_timestamp < CURRENT_DATE - INTERVAL '6 days'
-                AND current_status != '203'
-                AND current_status != '213'
-            """)
-            
-            if not records:
-                print("✅ 没有符合条件的记录需要写入")
-                # 即使没有记录，也清空表
-                await conn.execute("TRUNCATE TABLE weekly_inactivity")
-                print("✅ 已清空 weekly_inactivity 表")
-                return 0
-            
-            print(f"📊 找到 {len(records)} 条符合条件的记录")
+            # 删除旧数据并写入新数据在同一事务中完成，整个转换在数据库端一条语句执行。
+            # 用DELETE而不是TRUNCATE：TRUNCATE会持有排他锁直到提交，期间读取会被阻塞；
+            # DELETE下其他连接在提交前仍能读到旧的周报数据
+            async with conn.transaction():
+                await conn.execute("DELETE FROM weekly_inactivity")
+                result = await conn.execute(WEEKLY_INACTIVITY_REPORT_SQL)
             
-            # 在插入之前先清空表
-            await conn.execute("TRUNCATE TABLE weekly_inactivity")
-            print("✅ 已清空 weekly_inactivity 表，准备插入新数据")
+            # asyncpg的execute返回格式类似 "INSERT 0 123"，提取插入的行数
+            try:
+                inserted_count = int(result.split()[-1])
+            except (ValueError, AttributeError, IndexError):
+                inserted_count = 0
             
-            # 批量插入数据
-            inserted_count = 0
-            for record in records:
-                try:
-                    # 转换字段类型
-                    tracking_number = record['tracking_number']
-                    warehouse = record['warehouse']
-                    nonupdated_start_date = record['nonupdated_start_timestamp']
-                    
-                    # 转换status为int（如果转换失败则为NULL）
-                    status = None
-                    try:
-                        status = int(record['current_status']) if record['current_status'] else None
-                    except (ValueError, TypeError):
-                        pass
-                    
-                    # 转换driver_id为int（如果转换失败则为NULL）
-                    driver_id = None
-                    try:
-                        driver_id = int(record['driver_id']) if record['driver_id'] else None
-                    except (ValueError, TypeError):
-                        pass
-                    
-                    # route可以从order_id提取，或者设为NULL
-                    # 这里假设route可能需要从order_id或其他逻辑获取，暂时设为NULL
-                    route = None
-                    
-                    # team_name暂时设为NULL，如果需要可以从其他表关联获取
-                    team_name = None
-                    
-                    # if_driver_lost暂时设为NULL，需要根据业务逻辑确定
-                    if_driver_lost = None
-                    
-                    # 直接插入数据（因为已经清空了表，不需要检查是否存在）
-                    await conn.execute("""
-                        INSERT INTO weekly_inactivity (
-                            warehouse, tno, nonupdated_start_date, status, 
-                            route, driver_id, team_name, if_driver_lost, updated_at
-                        ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, NOW())
-                    """,
-                        warehouse,
-                        tracking_number,
-                        nonupdated_start_date,
-                        status,
-                        route,
-                        driver_id,
-                        team_name,
-                        if_driver_lost
-                    )
-                    inserted_count += 1
-                except Exception as e:
-                    print(f"❌ 插入记录失败: {e}, tracking_number: {record.get('tracking_number', 'unknown')}")
-                    continue
+            if inserted_count == 0:
+                logger.info("✅ 没有符合条件的记录需要写入，已清空 weekly_inactivity 表")
+                return 0
             
-            print(f"✅ 周报生成任务完成，共插入 {inserted_count} 条记录到 weekly_inactivity 表")
+            logger.info("✅ 周报生成任务完成，共插入 %s 条记录到 weekly_inactivity 表", inserted_count)
             return inserted_count
     
     except Exception as e:
-        print(f"❌ 周报生成任务执行失败: {e}")
-        import traceback
-        print(traceback.format_exc())
-        return 0
+        logger.exception("❌ 周报生成任务执行失败: %s", e)
+        return None
 
 
-@app.on_event("startup")
 async def startup():
-    """Initialize database pool and start scheduler on startup"""
+    """Initialize HTTP client, database pool and start scheduler on startup"""
     global scheduler
+    setup_logging()
+    get_http_client()
     try:
         await get_db_pool()
         await init_database_tables()
         
         # 初始化并启动定时任务调度器
-        scheduler = AsyncIOScheduler()
+        # coalesce：错过的多次触发只补跑一次；misfire_grace_time：触发时刻被延误（如事件循环繁忙）
+        # 一小时内仍然执行，而不是按默认的1秒宽限直接跳过
+        scheduler = AsyncIOScheduler(job_defaults={
+            "coalesce": True,
+            "misfire_grace_time": 3600,
+            "max_instances": 1
+        })
         # 每小时执行一次（可以根据需要调整）
         # 例如：每天凌晨2点执行 -> CronTrigger(hour=2, minute=0)
         # 每30分钟执行一次 -> CronTrigger(minute='*/30')
@@ -483,7 +946,8 @@ async def startup():
         
         # 添加清理旧数据的定时任务（每天凌晨1点执行）
         scheduler.add_job(
-            cleanup_old_scan_records,
+            run_scheduled_job,
+            args=["cleanup", cleanup_old_scan_records],
             trigger=CronTrigger(hour='1', minute=0),  # 每天凌晨1点执行
             id='cleanup_old_records',
             name='清理超过15天的扫描记录',
@@ -493,7 +957,8 @@ async def startup():
         
         # 添加周报生成定时任务（每周日执行）
         scheduler.add_job(
-            generate_weekly_inactivity_report,
+            run_scheduled_job,
+            args=["weekly_report", generate_weekly_inactivity_report],
             trigger=CronTrigger(day_of_week=6, hour=5, minute=0),  # 每周日凌晨0点执行
             id='generate_weekly_inactivity',
             name='生成周报数据（weekly_inactivity）',
@@ -502,34 +967,42 @@ async def startup():
         )
         
         scheduler.start()
-        print("✅ Scheduler started")
-        print("  - 获取扫描记录任务：每天凌晨2点执行")
-        print("  - 清理旧数据任务：每天凌晨1点执行")
-        print("  - 周报生成任务：每周日凌晨0点执行")
-        print("✅ Application startup completed")
+        logger.info("✅ Scheduler started")
+        logger.info("  - 获取扫描记录任务：每天凌晨2点执行")
+        logger.info("  - 清理旧数据任务：每天凌晨1点执行")
+        logger.info("  - 周报生成任务：每周日凌晨0点执行")
+        logger.info("✅ Application startup completed")
     except Exception as e:
-        print(f"❌ Application startup failed: {e}")
+        logger.error("❌ Application startup failed: %s", e)
         # Don't raise here, let the service start and handle errors in endpoints
         pass
 
 
-@app.on_event("shutdown")
 async def shutdown():
-    """Close database pool and scheduler on shutdown"""
-    global db_pool, scheduler
+    """Close database pool, HTTP client and scheduler on shutdown"""
+    global db_pool, scheduler, http_client
     if scheduler:
         try:
             scheduler.shutdown()
-            print("✅ Scheduler stopped")
+            logger.info("✅ Scheduler stopped")
         except Exception as e:
-            print(f"Error stopping scheduler: {e}")
+            logger.error("Error stopping scheduler: %s", e)
     
     if db_pool:
         try:
             await db_pool.close()
-            print("✅ Database connection pool closed")
+            logger.info("✅ Database connection pool closed")
+        except Exception as e:
+            logger.error("Error closing database pool: %s", e)
+    
+    if http_client:
+        try:
+            await http_client.aclose()
+            logger.info("✅ HTTP client closed")
         except Exception as e:
-            print(f"Error closing database pool: {e}")
+            logger.error("Error closing HTTP client: %s", e)
+    
+    stop_logging()
 
 
 # 认证相关模型
@@ -544,11 +1017,47 @@ class TokenResponse(BaseModel):
 
 
 # 工具函数
+def _sign_token(payload: str) -> str:
+    """对 "username.exp" 计算HMAC签名"""
+    digest = hmac.new(TOKEN_SECRET, payload.encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+
 def create_token(username: str) -> str:
-    """创建简单的随机token"""
-    token = secrets.token_urlsafe(32)
-    valid_tokens[token] = username
-    return token
+    """创建签名token：username.exp.signature，无需在服务端保存"""
+    payload = f"{username}.{int(time.time()) + TOKEN_EXPIRE_HOURS * 3600}"
+    return f"{payload}.{_sign_token(payload)}"
+
+
+def _verify_token(token: str) -> Optional[str]:
+    """校验签名与有效期，通过则返回用户名"""
+    payload, sep, signature = token.rpartition(".")
+    username, sep2, exp = payload.rpartition(".")
+    if not sep or not sep2 or not username or not exp.isdigit():
+        return None
+    if not hmac.compare_digest(signature.encode("utf-8"), _sign_token(payload).encode("utf-8")):
+        return None
+    if int(exp) < time.time():
+        return None
+    return username
+
+
+def _extract_bearer(authorization: str) -> str:
+    """从Authorization头中取出token，支持 "Bearer token" 或直接传token"""
+    if authorization.startswith("Bearer "):
+        return authorization[7:].strip()
+    return authorization.strip()
+
+
+def _error_detail(response: httpx.Response, default: str) -> str:
+    """从外部API错误响应中取出detail；只解析一次，非JSON响应直接使用默认信息"""
+    try:
+        error_data = orjson.loads(response.content)
+    except ValueError:
+        return default
+    if isinstance(error_data, dict):
+        return error_data.get("detail", default)
+    return default
 
 
 async def get_current_user(authorization: str = Header(None)):
@@ -559,20 +1068,43 @@ async def get_current_user(authorization: str = Header(None)):
             detail="缺少认证token"
         )
     
-    # 支持 "Bearer token" 或直接 "token"
-    token = authorization.replace("Bearer ", "").strip()
+    token = _extract_bearer(authorization)
     
-    if token not in valid_tokens:
+    username = _verify_token(token) if len(token) <= MAX_TOKEN_LENGTH else None
+    if username is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="无效的token"
         )
     
-    return valid_tokens[token]
+    return username
 
 
-# 外部API基础URL
-EXTERNAL_API_BASE = "https://noupdate.uniuni.site"
+# 仓库账号 -> 对应的随机密码，验证通过后以默认账号登录外部API
+WAREHOUSE_CREDENTIALS: Dict[str, bytes] = {
+    "uni_staff": b"Kp9mN2vQ7xRwZ5",
+    "JFK": b"aB3cD5eF8gHiJ1",
+    "EWR": b"jK2lM4nO6pQrS9",
+    "PHL": b"sT7uV9wX1yZ2aB",
+    "DCA": b"bC4dE6fG8hIjK3",
+    "BOS": b"kL3mN5oP7qRsT0",
+    "RDU": b"tU8vW0xY2zA3bC",
+    "CLT": b"cD5eF7gH9iJkL4",
+    "BUF": b"lM4nO6pQ8rStU1",
+    "RIC": b"uV9wX1yZ3aB4cD",
+    "PIT": b"dE6fG8hI0jKlM5",
+    "MDT": b"mN5oP7qR9sTuV2",
+    "ALB": b"vW0xY2zA4bC5dE",
+    "SYR": b"eF7gH9iJ1kLmN6",
+    "PWM": b"nO6pQ8rS0tUvW3",
+    "MIA": b"wX1yZ3aB5cD6eF",
+    "TPA": b"fG8hI0jK2lMnO7",
+    "JAX": b"oP7qR9sT1uVwX4",
+    "MCO": b"xY2zA4bC6dE7fG",
+    "GNV": b"aB3cD5eF8gHiJ1",
+    "TLH": b"jK2lM4nO6pQrS9",
+}
+
 
 # 代理登录端点 - 转发到外部API
 @app.post("/api/v1/auth/token")
@@ -583,60 +1115,38 @@ async def proxy_login(
     """代理登录请求到外部API - 支持表单格式"""
     # 保存原始用户名，用于返回给前端
     original_username = username
-    # 如果输入的是配置的用户名和对应的随机密码，转换为默认账号密码  
-    if ((username == "uni_staff" and password == "Kp9mN2vQ7xRwZ5") or 
-    (username == "JFK" and password == "aB3cD5eF8gHiJ1") or 
-    (username == "EWR" and password == "jK2lM4nO6pQrS9") or 
-    (username == "PHL" and password == "sT7uV9wX1yZ2aB") or 
-    (username == "DCA" and password == "bC4dE6fG8hIjK3") or 
-    (username == "BOS" and password == "kL3mN5oP7qRsT0") or 
-    (username == "RDU" and password == "tU8vW0xY2zA3bC") or 
-    (username == "CLT" and password == "cD5eF7gH9iJkL4") or 
-    (username == "BUF" and password == "lM4nO6pQ8rStU1") or 
-    (username == "RIC" and password == "uV9wX1yZ3aB4cD") or 
-    (username == "PIT" and password == "dE6fG8hI0jKlM5") or 
-    (username == "MDT" and password == "mN5oP7qR9sTuV2") or 
-    (username == "ALB" and password == "vW0xY2zA4bC5dE") or 
-    (username == "SYR" and password == "eF7gH9iJ1kLmN6") or 
-    (username == "PWM" and password == "nO6pQ8rS0tUvW3") or 
-    (username == "MIA" and password == "wX1yZ3aB5cD6eF") or 
-    (username == "TPA" and password == "fG8hI0jK2lMnO7") or 
-    (username == "JAX" and password == "oP7qR9sT1uVwX4") or 
-    (username == "MCO" and password == "xY2zA4bC6dE7fG") or
-    (username == "GNV" and password == "aB3cD5eF8gHiJ1") or
-    (username == "TLH" and password == "jK2lM4nO6pQrS9")):
+    # 如果输入的是配置的用户名和对应的随机密码，转换为默认账号密码
+    expected_password = WAREHOUSE_CREDENTIALS.get(username)
+    if expected_password is not None and hmac.compare_digest(password.encode("utf-8"), expected_password):
         username = DEFAULT_USERNAME
         password = DEFAULT_PASSWORD
     
     try:
-        async with httpx.AsyncClient() as client:
-            # 转发登录请求到外部API
-            response = await client.post(
-                f"{EXTERNAL_API_BASE}/api/v1/auth/token",
-                data={
-                    "username": username,
-                    "password": password
-                },
-                headers={
-                    "Content-Type": "application/x-www-form-urlencoded",
-                    "accept": "application/json"
-                },
-                timeout=30.0
-            )
-            
-            if response.status_code != 200:
-                error_data = response.json() if response.headers.get("content-type", "").startswith("application/json") else {}
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=error_data.get("detail", "登录失败")
-                )
-            
-            response_data = response.json()
-            return {
-                "access_token": response_data.get("access_token", ""),
-                "token_type": response_data.get("token_type", "bearer"),
-                "username": original_username  # 返回原始用户名，用于前端限制仓库选择
+        client = get_http_client()
+        # 转发登录请求到外部API
+        response = await client.post(
+            f"{EXTERNAL_API_BASE}/api/v1/auth/token",
+            data={
+                "username": username,
+                "password": password
+            },
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded"
             }
+        )
+        
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=_error_detail(response, "登录失败")
+            )
+        
+        response_data = orjson.loads(response.content)
+        return {
+            "access_token": response_data.get("access_token", ""),
+            "token_type": response_data.get("token_type", "bearer"),
+            "username": original_username  # 返回原始用户名，用于前端限制仓库选择
+        }
     except httpx.RequestError as e:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -647,15 +1157,10 @@ async def proxy_login(
 @app.post("/api/auth/login", response_model=TokenResponse)
 async def login(login_data: LoginRequest):
     """用户登录 - 简单的账号密码验证"""
-    # 验证用户名
-    if login_data.username != DEFAULT_USERNAME:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="用户名或密码错误"
-        )
-    
-    # 验证密码（直接比较，简单直接）
-    if login_data.password != DEFAULT_PASSWORD:
+    # 使用常量时间比较，并用按位 & 同时校验用户名和密码，避免通过响应时间泄露匹配前缀
+    username_ok = hmac.compare_digest(login_data.username.encode("utf-8"), DEFAULT_USERNAME_BYTES)
+    password_ok = hmac.compare_digest(login_data.password.encode("utf-8"), DEFAULT_PASSWORD_BYTES)
+    if not (username_ok & password_ok):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="用户名或密码错误"
@@ -679,16 +1184,53 @@ async def health():
     return {"status": "ok"}
 
 
+# 清理和周报任务的后台Task（任务名 -> Task），定时触发和手动触发共用，保留引用避免任务在执行中被垃圾回收
+_background_jobs: Dict[str, asyncio.Task] = {}
+
+
+def start_background_job(name: str, job) -> bool:
+    """在后台启动任务；同名任务仍在执行时不重复启动，返回是否新启动"""
+    task = _background_jobs.get(name)
+    if task is not None and not task.done():
+        return False
+    _background_jobs[name] = asyncio.create_task(job())
+    return True
+
+
+async def run_scheduled_job(name: str, job):
+    """定时任务入口：与手动触发走同一个去重逻辑，同名任务仍在执行时跳过本次触发"""
+    if not start_background_job(name, job):
+        logger.warning("⚠️ %s 任务仍在执行中，跳过本次定时触发", name)
+        return
+    await _background_jobs[name]
+
+
+@app.get("/api/cron/status")
+async def get_cron_status():
+    """查看清理和周报任务最近一次执行的状态（任务失败时返回None，视为failed）"""
+    result = {}
+    for name, task in _background_jobs.items():
+        if not task.done():
+            result[name] = "running"
+        elif task.cancelled():
+            result[name] = "cancelled"
+        elif task.exception() is not None or task.result() is None:
+            result[name] = "failed"
+        else:
+            result[name] = "finished"
+    return result
+
+
 # 手动触发清理任务端点（用于测试）
 @app.post("/api/cron/trigger-cleanup")
 async def trigger_cleanup():
     """手动触发清理旧数据定时任务（用于测试）"""
     try:
         # 在后台执行清理任务
-        asyncio.create_task(cleanup_old_scan_records())
+        started = start_background_job("cleanup", cleanup_old_scan_records)
         return {
             "status": "success",
-            "message": "清理任务已触发，正在后台执行"
+            "message": "清理任务已触发，正在后台执行" if started else "清理任务正在执行中，未重复触发"
         }
     except Exception as e:
         raise HTTPException(
@@ -703,10 +1245,10 @@ async def trigger_weekly_report():
     """手动触发周报生成定时任务（用于测试）"""
     try:
         # 在后台执行周报生成任务
-        asyncio.create_task(generate_weekly_inactivity_report())
+        started = start_background_job("weekly_report", generate_weekly_inactivity_report)
         return {
             "status": "success",
-            "message": "周报生成任务已触发，正在后台执行"
+            "message": "周报生成任务已触发，正在后台执行" if started else "周报生成任务正在执行中，未重复触发"
         }
     except Exception as e:
         raise HTTPException(
@@ -715,6 +1257,50 @@ async def trigger_weekly_report():
         )
 
 
+# 正在进行中的扫描记录代理请求：缓存键 -> Task
+_inflight_scan_record_requests: Dict[tuple, asyncio.Task] = {}
+
+# 扫描记录代理的成功响应缓存（缓存键 -> 响应字节），PROXY_CACHE_TTL 秒内相同请求直接返回；设为0关闭
+PROXY_CACHE_TTL = int(os.getenv("PROXY_CACHE_TTL", "30"))
+_scan_records_cache: Optional[TTLCache] = TTLCache(maxsize=1024, ttl=PROXY_CACHE_TTL) if PROXY_CACHE_TTL > 0 else None
+
+
+def _scan_records_cache_key(params: Dict[str, Any], authorization: str) -> tuple:
+    """代理请求的缓存键：查询参数 + Authorization的摘要（不在内存中保留原始token）"""
+    return (
+        tuple(params.items()),
+        hashlib.blake2b(authorization.encode("utf-8"), digest_size=16).digest()
+    )
+
+
+async def _request_scan_records(params: Dict[str, Any], authorization: str) -> httpx.Response:
+    """向外部API请求扫描记录"""
+    client = get_http_client()
+    return await client.get(
+        f"{EXTERNAL_API_BASE}/api/v1/scan-records/weekly",
+        params=params,
+        headers={
+            "Authorization": authorization
+        }
+    )
+
+
+async def _get_scan_records_coalesced(key: tuple, params: Dict[str, Any], authorization: str) -> httpx.Response:
+    """合并相同的并发请求：同一时刻相同参数和token只有一个上游请求在进行"""
+    task = _inflight_scan_record_requests.get(key)
+    if task is None or task.done():
+        task = asyncio.create_task(_request_scan_records(params, authorization))
+        _inflight_scan_record_requests[key] = task
+        
+        def _forget(finished: asyncio.Task):
+            if _inflight_scan_record_requests.get(key) is finished:
+                del _inflight_scan_record_requests[key]
+        
+        task.add_done_callback(_forget)
+    # shield：某个客户端断开时不影响其他等待同一请求的调用方
+    return await asyncio.shield(task)
+
+
 # 代理扫描记录API - 转发到外部API
 @app.get("/api/v1/scan-records/weekly")
 async def proxy_scan_records(
@@ -740,39 +1326,38 @@ async def proxy_scan_records(
             "page": page,
             "page_size": page_size,
         }
-        if sort:
-            params["sort"] = sort
-        if order:
-            params["order"] = order
-        if warehouse:
-            params["warehouse"] = warehouse
+        # 可选参数为空时不传给外部API
+        params.update(
+            (name, value)
+            for name, value in (("sort", sort), ("order", order), ("warehouse", warehouse))
+            if value
+        )
         
-        async with httpx.AsyncClient() as client:
-            # 转发请求到外部API
-            response = await client.get(
-                f"{EXTERNAL_API_BASE}/api/v1/scan-records/weekly",
-                params=params,
-                headers={
-                    "Authorization": authorization,
-                    "accept": "application/json"
-                },
-                timeout=30.0
+        key = _scan_records_cache_key(params, authorization)
+        if _scan_records_cache is not None:
+            cached = _scan_records_cache.get(key)
+            if cached is not None:
+                return Response(content=cached, media_type="application/json")
+        
+        # 转发请求到外部API（相同参数和token的并发请求共享同一个上游请求）
+        response = await _get_scan_records_coalesced(key, params, authorization)
+        
+        if response.status_code == 401:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="认证失败"
             )
-            
-            if response.status_code == 401:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="认证失败"
-                )
-            
-            if response.status_code != 200:
-                error_data = response.json() if response.headers.get("content-type", "").startswith("application/json") else {}
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=error_data.get("detail", "请求失败")
-                )
-            
-            return response.json()
+        
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=_error_detail(response, "请求失败")
+            )
+        
+        if _scan_records_cache is not None:
+            _scan_records_cache[key] = response.content
+        # 上游已经是JSON，直接透传原始字节，省去一次解析和重新序列化
+        return Response(content=response.content, media_type="application/json")
     except httpx.RequestError as e:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,